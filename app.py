@@ -1,15 +1,24 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from datetime import timedelta, datetime
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from timeloop import Timeloop
 
 
 from twitter import trigger_follower_processing, get_total_follower_count
-from db import get_all_records, get_high_value_followers
+from db import get_all_records, get_high_value_followers, get_records_by_ids, get_high_water_marks, \
+    get_changed_follower_ids
+from history import trigger_history_rollup, get_account_growth, get_follower_trajectory
+from maintenance import trigger_maintenance
+from backup import trigger_backup
+from snapshot import trigger_follower_snapshot, load_followers
+from config import backup_interval_hours
+from metrics import summarize_timings
 
 
 tl = Timeloop()
@@ -19,6 +28,25 @@ tl = Timeloop()
 @tl.job(interval=timedelta(hours=6))
 def start_follower_processing():
     trigger_follower_processing()
+    trigger_follower_snapshot()
+
+
+# Roll up follower history every hour
+@tl.job(interval=timedelta(hours=1))
+def start_history_rollup():
+    trigger_history_rollup()
+
+
+# Reclaim free pages and refresh query planner statistics every day
+@tl.job(interval=timedelta(days=1))
+def start_maintenance():
+    trigger_maintenance()
+
+
+# Back up database while the application keeps running
+@tl.job(interval=timedelta(hours=backup_interval_hours))
+def start_backup():
+    trigger_backup()
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -30,9 +58,16 @@ export_options = ["Export high value followers",
                   "Export all DM status",
                   "Export all skipped followers"]
 
+history_periods = {"Daily": "day",
+                   "Weekly": "week"}
+
 app.layout = html.Div([
     dcc.Graph(id='live-update-graph',
               style={'height': '100vh', 'width': '74%', 'float': 'center', 'display': 'inline-block'}),
+    # last seen max follower updated_seq and dm status rowid, kept per browser session
+    dcc.Store(id='graph-state'),
+    # full figure or changed follower points to apply on live-update-graph
+    dcc.Store(id='graph-delta'),
     html.Div([
         html.Br(),
         html.Br(),
@@ -44,6 +79,8 @@ app.layout = html.Div([
             html.Tr([html.Td('Skipped Followers: '), html.Td(id='skipped_followers')]),
             html.Tr([html.Td('DM Sent: '), html.Td(id='dm_sent')]),
             html.Tr([html.Td('Retry DM Sent: '), html.Td(id='retry_dm_sent')]),
+            html.Tr([html.Td('API Requests: '), html.Td(id='api_requests')]),
+            html.Tr([html.Td('Backups: '), html.Td(id='backups')]),
         ], style={'text-align': 'left', 'font-size': '1.5em'}),
         html.Br(),
         html.Br(),
@@ -56,8 +93,19 @@ app.layout = html.Div([
             id='interval-component',
             interval=30*60*1000,  # 30 minutes in milliseconds
             n_intervals=0
-        )
-    ], style={'height': '98vh', 'width': '98vw',
+        ),
+    html.Div([
+        dcc.RadioItems(id='history-period',
+                       options=[{'label': i, 'value': history_periods[i]} for i in history_periods],
+                       value=history_periods["Daily"],
+                       labelStyle={'display': 'inline-block'},
+                       style={'text-align': 'center', 'font-size': '1.5em'}),
+        dcc.Graph(id='account-growth-graph',
+                  style={'height': '50vh', 'width': '49%', 'display': 'inline-block'}),
+        dcc.Graph(id='follower-trajectory-graph',
+                  style={'height': '50vh', 'width': '49%', 'float': 'right', 'display': 'inline-block'})],
+        style={'clear': 'both'})
+    ], style={'min-height': '98vh', 'width': '98vw',
               'font': 'courier', 'background-color': 'rgb(0,172,238)'})
 
 
@@ -65,10 +113,12 @@ app.layout = html.Div([
                Output('fetched_followers', 'children'),
                Output('skipped_followers', 'children'),
                Output('dm_sent', 'children'),
-               Output('retry_dm_sent', 'children')],
+               Output('retry_dm_sent', 'children'),
+               Output('api_requests', 'children'),
+               Output('backups', 'children')],
               [Input('interval-component', 'n_intervals')])
 def update_metrics(n):
-    follower_df = get_all_records("follower")
+    follower_df = load_followers(['id'])
     dm_status_df = get_all_records("dm_status")
     skip_user_df = get_all_records("skip_user")
 
@@ -79,19 +129,25 @@ def update_metrics(n):
     unique_dm_count = dm_status_df.drop_duplicates('id').shape[0]
     skip_user_count = skip_user_df.shape[0]
 
-    return total_follower_count, fetch_follower_count, skip_user_count, unique_dm_count, dm_count-unique_dm_count
+    request_count, average_latency = summarize_timings('api ')
+    api_requests = f"{request_count} ({average_latency:.0f} ms avg)"
 
+    backup_count, average_backup_time = summarize_timings('backup')
+    backups = f"{backup_count} ({average_backup_time:.0f} ms avg)"
 
-@app.callback(Output('live-update-graph', 'figure'),
-              [Input('interval-component', 'n_intervals')])
-def update_graph_live(n):
-    follower_df = get_all_records("follower")
-    dm_status_df = get_all_records("dm_status")
+    return total_follower_count, fetch_follower_count, skip_user_count, unique_dm_count, dm_count-unique_dm_count, \
+        api_requests, backups
 
+
+def prepare_follower_df(follower_df, dm_status_df):
+    """ Add marker size, hover text and trace name of followers.
+    :param follower_df: Data Frame of follower details
+    :param dm_status_df: Data Frame of dm status of the followers
+    :return: Data Frame of follower details with plot columns
+    """
     follower_df['created_at'] = pd.to_datetime(follower_df['created_at'])
     today = datetime.now()
-    follower_df['years_on_twitter'] = \
-        follower_df['created_at'].apply(lambda x: today.year - x.year)
+    follower_df['years_on_twitter'] = today.year - follower_df['created_at'].dt.year
 
     dm_status_aggr = dm_status_df.groupby('id')['timestamp'].count().reset_index()
     dm_status_aggr.columns = ['id', 'dm_count']
@@ -102,55 +158,224 @@ def update_graph_live(n):
     follower_df = follower_df.merge(dm_status_aggr, on='id', how='left')
     follower_df['dm_count'] = follower_df['dm_count'].fillna("DM count: 0")
 
-    verified_follower_df = follower_df[follower_df['verified'] == 1]
-    unverified_follower_df = follower_df[follower_df['verified'] == 0]
+    follower_df['marker_size'] = follower_df['years_on_twitter'] * 2
+    follower_df['hover_text'] = follower_df['name'] + "<br>" + follower_df['dm_count']
+    follower_df['trace'] = np.where(follower_df['verified'] == 1, 'Verified', 'Unverified')
+
+    return follower_df
+
+
+follower_plot_columns = ['id', 'name', 'created_at', 'followers_count', 'friends_count', 'verified']
+
+
+def build_follower_figure():
+    """ Build scatter plot of all followers.
+    :return: Figure object
+    """
+    # followers from memory mapped snapshot, only rows changed since are read from database
+    follower_df = prepare_follower_df(load_followers(follower_plot_columns), get_all_records("dm_status"))
 
     fig = go.Figure()
 
-    if not verified_follower_df.empty:
+    for trace in ['Verified', 'Unverified']:
+        trace_df = follower_df[follower_df['trace'] == trace]
+
+        if not trace_df.empty:
+            fig.add_trace(
+                go.Scattergl(
+                    x=trace_df['followers_count'].tolist(),
+                    y=trace_df['friends_count'].tolist(),
+                    text=trace_df['hover_text'].tolist(),
+                    customdata=trace_df['id'].tolist(),
+                    mode='markers',
+                    marker=dict(
+                        size=trace_df['marker_size'].tolist(),
+                        colorscale='Viridis',
+                        line_width=1,
+                    ),
+                    name=trace
+                )
+            )
+
+    fig.update_layout(title='Followers vs. Friends of specific Follower',
+                      autosize=True,
+                      xaxis=dict(
+                          title='Followers',
+                          gridcolor='white',
+                          type='log',
+                          gridwidth=2,
+                      ),
+                      yaxis=dict(
+                          title='Friends',
+                          gridcolor='white',
+                          type='log',
+                          gridwidth=2,
+                      ),
+                      paper_bgcolor='rgb(243, 243, 243)',
+                      plot_bgcolor='rgb(243, 243, 243)')
+
+    return fig
+
+
+def build_follower_points(follower_ids):
+    """ Build plot points of the given followers, to be applied on the figure client side.
+    :param follower_ids: follower ids
+    :return: dict of point attribute to list of values
+    """
+    follower_df = prepare_follower_df(get_records_by_ids("follower", follower_ids),
+                                      get_records_by_ids("dm_status", follower_ids))
+
+    return {'id': follower_df['id'].tolist(),
+            'trace': follower_df['trace'].tolist(),
+            'x': follower_df['followers_count'].tolist(),
+            'y': follower_df['friends_count'].tolist(),
+            'size': follower_df['marker_size'].tolist(),
+            'text': follower_df['hover_text'].tolist()}
+
+
+@app.callback([Output('graph-delta', 'data'),
+               Output('graph-state', 'data')],
+              [Input('interval-component', 'n_intervals')],
+              [State('graph-state', 'data')])
+def update_graph_live(n, graph_state):
+    # read high water marks first, rows added while building are sent again next time
+    high_water_marks = get_high_water_marks()
+
+    # full rebuild for a new session, a session of an older version or when marks went back,
+    # e.g. after restoring a backup
+    if graph_state is None or graph_state.keys() != high_water_marks.keys() or \
+            any(graph_state[table_name] > high_water_marks[table_name] for table_name in high_water_marks):
+        return {'figure': build_follower_figure()}, high_water_marks
+
+    if graph_state == high_water_marks:
+        raise PreventUpdate
+
+    follower_ids = get_changed_follower_ids(graph_state)
+
+    return {'points': build_follower_points(follower_ids)}, high_water_marks
+
+
+# Apply figure or changed follower points from graph-delta on the figure in the browser
+app.clientside_callback(
+    """
+    function(delta, figure) {
+        if (!delta) {
+            return window.dash_clientside.no_update;
+        }
+
+        if (delta.figure) {
+            return delta.figure;
+        }
+
+        if (!figure) {
+            return window.dash_clientside.no_update;
+        }
+
+        var points = delta.points;
+        var pending = new Map();
+        for (var i = 0; i < points.id.length; i++) {
+            pending.set(points.id[i], i);
+        }
+
+        var data = figure.data.map(function(trace) {
+            var keep = [];
+            var x = Array.from(trace.x);
+            var y = Array.from(trace.y);
+            var text = Array.from(trace.text);
+            var size = Array.from(trace.marker.size);
+
+            for (var j = 0; j < trace.customdata.length; j++) {
+                var i = pending.get(trace.customdata[j]);
+
+                if (i === undefined) {
+                    keep.push(j);
+                } else if (points.trace[i] === trace.name) {
+                    x[j] = points.x[i];
+                    y[j] = points.y[i];
+                    text[j] = points.text[i];
+                    size[j] = points.size[i];
+                    pending.delete(trace.customdata[j]);
+                    keep.push(j);
+                }
+            }
+
+            var pick = function(values) {
+                return keep.length === values.length ? values : keep.map(function(j) { return values[j]; });
+            };
+
+            return Object.assign({}, trace, {
+                x: pick(x),
+                y: pick(y),
+                text: pick(text),
+                customdata: pick(Array.from(trace.customdata)),
+                marker: Object.assign({}, trace.marker, {size: pick(size)})
+            });
+        });
+
+        pending.forEach(function(i) {
+            var trace = data.find(function(trace) { return trace.name === points.trace[i]; });
+
+            if (!trace) {
+                trace = {type: 'scattergl', mode: 'markers', name: points.trace[i],
+                         x: [], y: [], text: [], customdata: [],
+                         marker: {size: [], colorscale: 'Viridis', line: {width: 1}}};
+                data.push(trace);
+            }
+
+            trace.x.push(points.x[i]);
+            trace.y.push(points.y[i]);
+            trace.text.push(points.text[i]);
+            trace.customdata.push(points.id[i]);
+            trace.marker.size.push(points.size[i]);
+        });
+
+        var layout = Object.assign({}, figure.layout, {datarevision: (figure.layout.datarevision || 0) + 1});
+
+        return Object.assign({}, figure, {data: data, layout: layout});
+    }
+    """,
+    Output('live-update-graph', 'figure'),
+    [Input('graph-delta', 'data')],
+    [State('live-update-graph', 'figure')])
+
+
+def build_history_figure(history_df, title):
+    """ Build line figure of followers and friends count over time.
+    :param history_df: Data Frame of history rollups
+    :param title: figure title
+    :return: Figure object
+    """
+    fig = go.Figure()
+
+    if not history_df.empty:
         fig.add_trace(
-            go.Scattergl(
-                x=verified_follower_df['followers_count'],
-                y=verified_follower_df['friends_count'],
-                text=verified_follower_df['name'] + "<br>" + verified_follower_df['dm_count'],
-                mode='markers',
-                marker=dict(
-                    size=verified_follower_df['years_on_twitter'] * 2,
-                    colorscale='Viridis',
-                    line_width=1,
-                ),
-                name='Verified'
+            go.Scatter(
+                x=history_df['period_start'],
+                y=history_df['followers_count'],
+                line_shape='hv',
+                mode='lines+markers',
+                name='Followers'
             )
         )
 
-    if not unverified_follower_df.empty:
         fig.add_trace(
-            go.Scattergl(
-                x=unverified_follower_df['followers_count'],
-                y=unverified_follower_df['friends_count'],
-                text=unverified_follower_df['name'] + "<br>" + unverified_follower_df['dm_count'],
-                mode='markers',
-                marker=dict(
-                    size=unverified_follower_df['years_on_twitter'] * 2,
-                    colorscale='Viridis',
-                    line_width=1,
-                ),
-                name='Unverified'
+            go.Scatter(
+                x=history_df['period_start'],
+                y=history_df['friends_count'],
+                line_shape='hv',
+                mode='lines+markers',
+                name='Friends'
             )
         )
 
-    fig.update_layout(title='Followers vs. Friends of specific Follower',
+    fig.update_layout(title=title,
                       autosize=True,
                       xaxis=dict(
-                          title='Followers',
                           gridcolor='white',
-                          type='log',
                           gridwidth=2,
                       ),
                       yaxis=dict(
-                          title='Friends',
                           gridcolor='white',
-                          type='log',
                           gridwidth=2,
                       ),
                       paper_bgcolor='rgb(243, 243, 243)',
@@ -159,6 +384,28 @@ def update_graph_live(n):
     return fig
 
 
+@app.callback(Output('account-growth-graph', 'figure'),
+              [Input('interval-component', 'n_intervals'),
+               Input('history-period', 'value')])
+def update_account_growth(n, period):
+    account_growth_df = get_account_growth(period)
+
+    return build_history_figure(account_growth_df, 'Account Growth')
+
+
+@app.callback(Output('follower-trajectory-graph', 'figure'),
+              [Input('live-update-graph', 'clickData'),
+               Input('history-period', 'value')])
+def update_follower_trajectory(click_data, period):
+    if not click_data:
+        return build_history_figure(pd.DataFrame(), 'Follower Trajectory (click on a follower)')
+
+    point = click_data['points'][0]
+    trajectory_df = get_follower_trajectory(point['customdata'], period)
+
+    return build_history_figure(trajectory_df, f"Follower Trajectory: {point['text'].split('<br>')[0]}")
+
+
 @app.callback(
     Output('export-options-output', component_property='children'),
     [Input('export-options', 'value')])
@@ -196,6 +443,8 @@ def export_data(export_option):
 
 if __name__ == '__main__':
     trigger_follower_processing()
+    trigger_follower_snapshot()
+    trigger_history_rollup()
     tl.start()
     try:
         print(f"Started twitter-export application.")
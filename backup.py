@@ -0,0 +1,334 @@
+import argparse
+from datetime import datetime
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import struct
+import time
+
+from config import db_file, backup_dir, backup_keep, backup_pages_per_step, backup_step_sleep, \
+    backup_incremental, backup_full_every
+from metrics import record_timing
+
+
+# Incremental backup file layout: magic, page size, page count, then (page number, page) records
+delta_magic = b'TXDELTA1'
+delta_header = struct.Struct('>II')
+delta_page_number = struct.Struct('>I')
+
+backup_prefix = os.path.splitext(os.path.basename(db_file))[0]
+latest_backup_file = os.path.join(backup_dir, f"{backup_prefix}-latest.db")
+
+# Temporary files left by an interrupted backup are removed once older than this
+stale_tmp_seconds = 24 * 60 * 60
+
+
+def online_backup(target_file):
+    """ Copy database into target file with sqlite online backup api. A few pages are
+    copied per step and readers and writers can use the database in between.
+    :param target_file: backup file
+    :return: None
+    """
+    def progress(status, remaining, total):
+        time.sleep(backup_step_sleep)
+
+    src = sqlite3.connect(db_file, isolation_level=None)
+    dst = sqlite3.connect(target_file)
+    try:
+        # Hold one read transaction for all steps. In WAL mode writers carry on and every
+        # step reads the same snapshot, else each write from another connection restarts the backup.
+        src.execute("BEGIN")
+        src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        src.backup(dst, pages=backup_pages_per_step, progress=progress)
+        src.execute("COMMIT")
+    finally:
+        dst.close()
+        src.close()
+
+
+def check_integrity(backup_file):
+    """ Run sqlite integrity check on a backup file.
+    :param backup_file: database file
+    :return: True if backup is intact else False
+    """
+    conn = sqlite3.connect(backup_file)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    except sqlite3.Error as e:
+        result = str(e)
+    finally:
+        conn.close()
+
+    if result != 'ok':
+        print(f"Error! integrity check of {backup_file} failed: {result}")
+        return False
+
+    return True
+
+
+def get_page_size(database_file):
+    """ Get page size of a database file.
+    :param database_file: database file
+    :return: page size in bytes
+    """
+    conn = sqlite3.connect(database_file)
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    conn.close()
+
+    return page_size
+
+
+def write_delta(base_file, new_file, delta_file):
+    """ Write gzip compressed pages of new_file which differ from base_file.
+    :param base_file: database file the delta applies on
+    :param new_file: database file the delta restores
+    :param delta_file: delta file to write
+    :return: number of changed pages
+    """
+    page_size = get_page_size(new_file)
+    page_count = os.path.getsize(new_file) // page_size
+    changed_pages = 0
+
+    with open(base_file, 'rb') as base, open(new_file, 'rb') as new, gzip.open(delta_file, 'wb') as delta:
+        delta.write(delta_magic)
+        delta.write(delta_header.pack(page_size, page_count))
+
+        for page_number in range(page_count):
+            page = new.read(page_size)
+            if page != base.read(page_size):
+                delta.write(delta_page_number.pack(page_number))
+                delta.write(page)
+                changed_pages += 1
+
+    return changed_pages
+
+
+def apply_delta(database_file, delta_file):
+    """ Apply pages of a delta file on a database file.
+    :param database_file: database file restored so far
+    :param delta_file: delta file
+    :return: None
+    """
+    with gzip.open(delta_file, 'rb') as delta, open(database_file, 'r+b') as database:
+        if delta.read(len(delta_magic)) != delta_magic:
+            raise ValueError(f"{delta_file} is not a twitter export delta backup")
+
+        page_size, page_count = delta_header.unpack(delta.read(delta_header.size))
+
+        while True:
+            record = delta.read(delta_page_number.size)
+            if not record:
+                break
+
+            page_number, = delta_page_number.unpack(record)
+            database.seek(page_number * page_size)
+            database.write(delta.read(page_size))
+
+        database.truncate(page_count * page_size)
+
+
+def gzip_file(source_file, target_file):
+    """ Gzip compress a file.
+    :param source_file: file to compress
+    :param target_file: compressed file
+    :return: None
+    """
+    with open(source_file, 'rb') as source, gzip.open(target_file, 'wb') as target:
+        shutil.copyfileobj(source, target)
+
+
+def gunzip_file(source_file, target_file):
+    """ Decompress a gzip file.
+    :param source_file: compressed file
+    :param target_file: decompressed file
+    :return: None
+    """
+    with gzip.open(source_file, 'rb') as source, open(target_file, 'wb') as target:
+        shutil.copyfileobj(source, target)
+
+
+def get_full_backups():
+    """ Get full backup files, oldest first.
+    :return: list of backup files
+    """
+    if backup_incremental:
+        return sorted(glob.glob(os.path.join(backup_dir, f"{backup_prefix}-*.full.db.gz")))
+
+    return sorted(glob.glob(os.path.join(backup_dir, f"{backup_prefix}-[0-9]*.db")))
+
+
+def get_delta_backups(full_backup_file):
+    """ Get incremental backup files based on a full backup, oldest first.
+    :param full_backup_file: full backup file
+    :return: list of delta backup files
+    """
+    base = full_backup_file[:-len('.full.db.gz')]
+
+    return sorted(glob.glob(f"{base}.delta-*.gz"))
+
+
+def rotate_backups():
+    """ Delete full backups, and their incremental backups, beyond backup_keep.
+    :return: None
+    """
+    full_backups = get_full_backups()
+
+    for full_backup_file in full_backups[:-backup_keep]:
+        if backup_incremental:
+            for delta_backup_file in get_delta_backups(full_backup_file):
+                os.remove(delta_backup_file)
+
+        os.remove(full_backup_file)
+        print(f"Removed old backup {full_backup_file}")
+
+
+def remove_stale_tmp_files():
+    """ Remove temporary files of backups which were interrupted.
+    :return: None
+    """
+    for tmp_file in glob.glob(os.path.join(backup_dir, f".{backup_prefix}-*.tmp")) + \
+            glob.glob(os.path.join(backup_dir, f"{backup_prefix}-*.tmp")):
+        if time.time() - os.path.getmtime(tmp_file) > stale_tmp_seconds:
+            os.remove(tmp_file)
+            print(f"Removed stale backup file {tmp_file}")
+
+
+def create_backup():
+    """ Back up database into backup_dir, check its integrity and rotate old backups.
+    In incremental mode a gzip full backup starts a chain of gzip deltas of changed pages.
+    :return: backup file or None if backup failed
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    remove_stale_tmp_files()
+
+    current_time = datetime.now().strftime("%Y%m%dT%H%M%S")
+    tmp_file = os.path.join(backup_dir, f".{backup_prefix}-{current_time}.tmp")
+    backup_file = None
+
+    try:
+        online_backup(tmp_file)
+
+        if not check_integrity(tmp_file):
+            return None
+
+        if not backup_incremental:
+            backup_file = os.path.join(backup_dir, f"{backup_prefix}-{current_time}.db")
+            os.replace(tmp_file, backup_file)
+
+        else:
+            full_backups = get_full_backups()
+
+            if (not full_backups or not os.path.exists(latest_backup_file)
+                    or len(get_delta_backups(full_backups[-1])) + 1 >= backup_full_every):
+                backup_file = os.path.join(backup_dir, f"{backup_prefix}-{current_time}.full.db.gz")
+                gzip_file(tmp_file, backup_file + '.tmp')
+            else:
+                base = full_backups[-1][:-len('.full.db.gz')]
+                backup_file = f"{base}.delta-{current_time}.gz"
+                changed_pages = write_delta(latest_backup_file, tmp_file, backup_file + '.tmp')
+                print(f"Incremental backup of {changed_pages} changed pages.")
+
+            os.replace(backup_file + '.tmp', backup_file)
+
+            # uncompressed copy of the last backup, incremental backups are computed against it
+            os.replace(tmp_file, latest_backup_file)
+
+    finally:
+        # left over only if the backup failed
+        for file in [tmp_file, backup_file and backup_file + '.tmp']:
+            if file and os.path.exists(file):
+                os.remove(file)
+
+    rotate_backups()
+
+    return backup_file
+
+
+def trigger_backup():
+    """ Back up database and record backup duration in metrics.
+    :return: None
+    """
+    print("Triggering database backup")
+
+    start_time = time.perf_counter()
+    try:
+        backup_file = create_backup()
+    except (sqlite3.Error, OSError) as e:
+        # e.g. disk full or database locked, retried on next run
+        print(f"Error! database backup failed: {str(e)}")
+        return
+
+    record_timing("backup", time.perf_counter() - start_time)
+
+    if backup_file:
+        print(f"Database backed up to {backup_file}")
+
+
+def restore_backup(backup_file, target_file):
+    """ Restore database from a backup file. For an incremental backup, its full backup
+    and the incremental backups up to it are applied in order.
+    :param backup_file: backup file
+    :param target_file: database file to restore into
+    :return: True if restored else False
+    """
+    tmp_file = target_file + '.restore'
+
+    if backup_file.endswith('.full.db.gz'):
+        gunzip_file(backup_file, tmp_file)
+
+    elif '.delta-' in backup_file:
+        full_backup_file = backup_file.split('.delta-')[0] + '.full.db.gz'
+        gunzip_file(full_backup_file, tmp_file)
+
+        for delta_backup_file in get_delta_backups(full_backup_file):
+            if delta_backup_file > backup_file:
+                break
+            apply_delta(tmp_file, delta_backup_file)
+
+    else:
+        shutil.copyfile(backup_file, tmp_file)
+
+    if not check_integrity(tmp_file):
+        os.remove(tmp_file)
+        return False
+
+    os.replace(tmp_file, target_file)
+
+    # drop journal of the replaced database
+    for journal_file in [target_file + '-journal', target_file + '-wal', target_file + '-shm']:
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Back up or restore twitter export database.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('backup', help="Back up database now.")
+    subparsers.add_parser('list', help="List backups.")
+
+    restore_parser = subparsers.add_parser('restore', help="Restore database from a backup. "
+                                                           "Stop the application before restoring.")
+    restore_parser.add_argument('backup_file', help="Backup file to restore.")
+    restore_parser.add_argument('--target', default=db_file, help="Database file to restore into.")
+
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        trigger_backup()
+
+    elif args.command == 'list':
+        for full_backup_file in get_full_backups():
+            print(full_backup_file)
+            if backup_incremental:
+                for delta_backup_file in get_delta_backups(full_backup_file):
+                    print(f"  {delta_backup_file}")
+
+    elif args.command == 'restore':
+        if restore_backup(args.backup_file, args.target):
+            print(f"Restored {args.target} from {args.backup_file}")
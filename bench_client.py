@@ -0,0 +1,112 @@
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import gzip
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import tweepy
+
+
+# 100 users as returned by users/lookup
+lookup_response = json.dumps([{'id': i, 'name': f"user{i}", 'created_at': 'Fri Jan 01 00:00:00 +0000 2010',
+                               'description': 'x' * 120, 'followers_count': i, 'friends_count': 5,
+                               'verified': False} for i in range(100)]).encode()
+
+# client address of every request, one per TCP/TLS connection
+client_addresses = set()
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """ Keep-alive stand-in for twitter users/lookup, gzip compressed when requested. """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        client_addresses.add(self.client_address)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        body = lookup_response
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compressed:
+            body = gzip.compress(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(cert_dir):
+    """ Start TLS stand-in server with a self-signed certificate for localhost.
+    :param cert_dir: directory for certificate and key
+    :return: (host:port, certificate file)
+    """
+    cert_file = os.path.join(cert_dir, 'cert.pem')
+    key_file = os.path.join(cert_dir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key_file, '-out', cert_file],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    server = ThreadingHTTPServer(('localhost', 0), LookupHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f"localhost:{server.server_address[1]}", cert_file
+
+
+def bench(name, call, count):
+    """ Time repeated calls and print latency and number of connections opened.
+    :param name: benchmark name
+    :param call: function doing one lookup
+    :param count: number of calls
+    :return: None
+    """
+    client_addresses.clear()
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+
+    for _ in range(count):
+        users = call()
+
+    wall = (time.perf_counter() - start_time) / count * 1000
+    cpu = (time.process_time() - start_cpu) / count * 1000
+    print(f"{name}: {wall:.2f} ms/call wall, {cpu:.2f} ms/call cpu (client and server), "
+          f"{len(client_addresses)} TLS connections, {len(users)} users")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare tweepy.API per call with the shared TwitterClient "
+                                                 "against a local TLS stand-in for twitter users/lookup.")
+    parser.add_argument('--count', type=int, default=300, help="Number of lookups per benchmark.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cert_dir:
+        host, cert_file = start_server(cert_dir)
+
+        # trust the self-signed certificate in requests, used by tweepy and TwitterClient
+        os.environ['REQUESTS_CA_BUNDLE'] = cert_file
+
+        from client import TwitterClient
+
+        user_ids = list(range(100))
+        auth = tweepy.OAuthHandler('key', 'secret')
+        auth.set_access_token('token', 'token_secret')
+
+        bench("tweepy.API per call", lambda: tweepy.API(auth, host=host).lookup_users(user_ids), args.count)
+
+        client = TwitterClient(api_root=f"https://{host}/1.1")
+        bench("shared TwitterClient", lambda: client.lookup_users(user_ids), args.count)
@@ -0,0 +1,149 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+import tweepy
+
+from config import consumer_key, consumer_secret, access_token, access_token_secret, \
+    http_connect_timeout, http_read_timeout, http_pool_maxsize
+from metrics import record_timing
+
+
+class TwitterClient:
+    """ Twitter REST API client for the calls used by twitter export.
+    All calls share one keep-alive HTTP session and OAuth signer, request gzip
+    responses and record their duration in metrics. Errors are raised as tweepy
+    errors so callers handle them the same way as tweepy api calls.
+    """
+
+    def __init__(self, api_root='https://api.twitter.com/1.1'):
+        self.api_root = api_root
+        self.timeout = (http_connect_timeout, http_read_timeout)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_maxsize)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        self.session.auth = OAuth1(consumer_key,
+                                   client_secret=consumer_secret,
+                                   resource_owner_key=access_token,
+                                   resource_owner_secret=access_token_secret,
+                                   decoding=None)
+
+    def request(self, method, endpoint, params=None, data=None, json_payload=None):
+        """ Send request to twitter.
+        :param method: HTTP method
+        :param endpoint: API endpoint relative to api root
+        :param params: query parameters
+        :param data: form data
+        :param json_payload: JSON body
+        :return: decoded JSON response
+        """
+        start_time = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.api_root + endpoint, params=params,
+                                        data=data, json=json_payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise tweepy.TweepError(f"Failed to send request: {e}")
+        finally:
+            record_timing(f"api {endpoint}", time.perf_counter() - start_time)
+
+        if not 200 <= resp.status_code < 300:
+            error_msg = f"Twitter error response: status code = {resp.status_code}"
+            api_error_code = None
+
+            try:
+                errors = resp.json()['errors']
+                error_msg = errors[0]['message']
+                api_error_code = errors[0]['code']
+            except (ValueError, KeyError, IndexError, TypeError):
+                pass
+
+            # 88: Rate limit exceeded
+            if resp.status_code == 429 or api_error_code == 88:
+                raise tweepy.RateLimitError(error_msg, resp)
+
+            raise tweepy.TweepError(error_msg, resp, api_code=api_error_code)
+
+        if not resp.content:
+            return None
+
+        return resp.json()
+
+    def me(self):
+        """ Get authenticated user.
+        :return: user information
+        """
+        return self.request('GET', '/account/verify_credentials.json')
+
+    def followers_ids(self):
+        """ Iterate over follower ids of authenticated user, most recent first.
+        On rate limit the same page is requested again after 15 minutes.
+        :return: generator of follower ids
+        """
+        cursor = -1
+        while cursor:
+            try:
+                page = self.request('GET', '/followers/ids.json', params={'cursor': cursor, 'count': 5000})
+            except tweepy.RateLimitError as e:
+                print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
+                time.sleep(60 * 15)
+                continue
+
+            for follower_id in page['ids']:
+                yield follower_id
+
+            cursor = page['next_cursor']
+
+    def lookup_users(self, user_ids=None, screen_names=None):
+        """ Lookup up to 100 users by id or screen name.
+        :param user_ids: list of user ids
+        :param screen_names: list of screen names
+        :return: list of user information
+        """
+        data = {}
+        if user_ids:
+            data['user_id'] = ','.join(str(user_id) for user_id in user_ids)
+        if screen_names:
+            data['screen_name'] = ','.join(screen_names)
+
+        return self.request('POST', '/users/lookup.json', data=data)
+
+    def send_direct_message(self, recipient_id, text):
+        """ Send direct message.
+        :param recipient_id: recipient user id
+        :param text: message text
+        :return: message event
+        """
+        json_payload = {'event': {'type': 'message_create',
+                                  'message_create': {'target': {'recipient_id': recipient_id},
+                                                     'message_data': {'text': text}}}}
+
+        return self.request('POST', '/direct_messages/events/new.json', json_payload=json_payload)
+
+    def rate_limit_status(self, resources):
+        """ Get rate limit status.
+        :param resources: comma separated resource families
+        :return: rate limit status
+        """
+        return self.request('GET', '/application/rate_limit_status.json', params={'resources': resources})
+
+
+api = None
+api_lock = threading.Lock()
+
+
+def get_api():
+    """ Get twitter api client shared by the whole process.
+    :return: TwitterClient object
+    """
+    global api
+
+    with api_lock:
+        if api is None:
+            api = TwitterClient()
+
+    return api
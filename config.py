@@ -10,14 +10,40 @@ consumer_secret = config_data['twitter']['consumer_secret']
 access_token = config_data['twitter']['access_token']
 access_token_secret = config_data['twitter']['access_token_secret']
 
+print("Loading http configurations.")
+http_connect_timeout = config_data['http']['connect_timeout']
+http_read_timeout = config_data['http']['read_timeout']
+http_pool_maxsize = config_data['http']['pool_maxsize']
+
 print("Loading db file path")
 db_file = config_data['db_file']
 
+print("Loading backup configurations.")
+backup_dir = config_data['backup']['backup_dir']
+backup_interval_hours = config_data['backup']['interval_hours']
+backup_keep = config_data['backup']['keep']
+backup_pages_per_step = config_data['backup']['pages_per_step']
+backup_step_sleep = config_data['backup']['step_sleep']
+backup_incremental = config_data['backup']['incremental']
+backup_full_every = config_data['backup']['full_every']
+if backup_keep < 1:
+    raise ValueError("backup keep must be at least 1.")
+
 print("Loading DM messages.")
 enable_dm_flag = config_data['enable_dm_flag']
 message = config_data['message']
 retry_message = config_data['retry_message']
 retry_after_days = config_data['retry_after_days']
+dm_message_templates = config_data['dm_templates']['message']
+dm_retry_message_templates = config_data['dm_templates']['retry_message']
+
+print("Loading follower history configurations.")
+history_raw_retention_days = config_data['follower_history']['raw_retention_days']
+history_daily_retention_days = config_data['follower_history']['daily_retention_days']
+
+print("Loading profile refresh configurations.")
+profile_refresh_stale_after_days = config_data['profile_refresh']['stale_after_days']
+profile_refresh_max_batches = config_data['profile_refresh']['max_batches']
 
 print("Loading filters for followers.")
 filter_created_before = config_data['follower_filters']['created_before']
@@ -27,6 +53,10 @@ filter_min_friends_count = config_data['follower_filters']['min_friends_count']
 filter_max_friends_count = config_data['follower_filters']['max_friends_count']
 filter_verified_only = config_data['follower_filters']['verified_only']
 
+print("Loading follower scoring configurations.")
+scoring_weights = config_data['follower_scoring']['weights']
+scoring_keywords = config_data['follower_scoring']['keywords']
+
 print("Loading test configurations.")
 test_flag = config_data['test_flag']
 test_accounts = config_data['test_accounts']
@@ -38,6 +38,53 @@ def create_table(conn, create_table_sql):
     return True
 
 
+def add_column(conn, table_name, column_name, column_type):
+    """ add a column to a table created by an older version, if missing
+    :param conn: Connection object
+    :param table_name: table name
+    :param column_name: column name
+    :param column_type: column type
+    :return: True is column is present or added successfully else False
+    """
+    columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table_name})")]
+    if column_name in columns:
+        return True
+
+    return create_table(conn, f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+
+def create_unique_index(conn, index_name, table_name, columns):
+    """ create a unique index, first removing duplicate rows left by older versions
+    :param conn: Connection object
+    :param index_name: index name
+    :param table_name: table name
+    :param columns: list of columns which must be unique together
+    :return: True is index is created successfully else False
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,))
+    if cur.fetchone() is not None:
+        return True
+
+    column_list = ', '.join(columns)
+
+    try:
+        # keep the first inserted row of every duplicate group
+        cur.execute(f"""DELETE FROM {table_name} WHERE rowid NOT IN
+                            (SELECT min(rowid) FROM {table_name} GROUP BY {column_list})""")
+        if cur.rowcount:
+            print(f"Removed {cur.rowcount} duplicate rows from {table_name}.")
+
+        cur.execute(f"CREATE UNIQUE INDEX {index_name} ON {table_name} ({column_list})")
+        conn.commit()
+    except Error as e:
+        print(e)
+        conn.rollback()
+        return False
+
+    return True
+
+
 def init_db():
     """ initialise sqllite db
     :param db_file: database file
@@ -52,12 +99,57 @@ def init_db():
                                         description text,
                                         followers_count integer,
                                         friends_count integer,
-                                        verified integer
+                                        verified integer,
+                                        last_refreshed_at text,
+                                        score real,
+                                        updated_seq integer
+                                    ); """
+
+    sql_create_follower_refresh_index = """ CREATE INDEX IF NOT EXISTS follower_last_refreshed_at_idx
+                                            ON follower (last_refreshed_at); """
+
+    sql_create_follower_score_index = """ CREATE INDEX IF NOT EXISTS follower_score_idx
+                                          ON follower (score); """
+
+    sql_create_follower_updated_seq_index = """ CREATE INDEX IF NOT EXISTS follower_updated_seq_idx
+                                                ON follower (updated_seq); """
+
+    # full text index on follower description, kept in sync with follower table by triggers
+    sql_create_follower_fts_table = """ CREATE VIRTUAL TABLE follower_fts
+                                        USING fts5(description, content='follower', content_rowid='id'); """
+
+    sql_create_follower_fts_triggers = [
+        """ CREATE TRIGGER IF NOT EXISTS follower_fts_insert AFTER INSERT ON follower BEGIN
+                INSERT INTO follower_fts(rowid, description) VALUES (new.id, new.description);
+            END; """,
+        """ CREATE TRIGGER IF NOT EXISTS follower_fts_delete AFTER DELETE ON follower BEGIN
+                INSERT INTO follower_fts(follower_fts, rowid, description)
+                VALUES ('delete', old.id, old.description);
+            END; """,
+        """ CREATE TRIGGER IF NOT EXISTS follower_fts_update AFTER UPDATE OF description ON follower BEGIN
+                INSERT INTO follower_fts(follower_fts, rowid, description)
+                VALUES ('delete', old.id, old.description);
+                INSERT INTO follower_fts(rowid, description) VALUES (new.id, new.description);
+            END; """,
+    ]
+
+    sql_create_scoring_state_table = """ CREATE TABLE IF NOT EXISTS scoring_state (
+                                        name text PRIMARY KEY,
+                                        fingerprint text
                                     ); """
 
     sql_create_dm_status_table = """ CREATE TABLE IF NOT EXISTS dm_status (
                                     id integer,
-                                    timestamp text
+                                    timestamp text,
+                                    variant integer
+                                ); """
+
+    sql_create_dm_outbox_table = """ CREATE TABLE IF NOT EXISTS dm_outbox (
+                                    id integer PRIMARY KEY,
+                                    retry integer,
+                                    variant integer,
+                                    body text,
+                                    created_at text
                                 ); """
 
     sql_create_skip_user_table = """ CREATE TABLE IF NOT EXISTS skip_user (
@@ -65,6 +157,51 @@ def init_db():
                                     timestamp text
                                 ); """
 
+    sql_create_follower_history_table = """ CREATE TABLE IF NOT EXISTS follower_history (
+                                            id integer NOT NULL,
+                                            timestamp text NOT NULL,
+                                            followers_count integer,
+                                            friends_count integer,
+                                            PRIMARY KEY (id, timestamp)
+                                        ); """
+
+    sql_create_follower_history_index = """ CREATE INDEX IF NOT EXISTS follower_history_timestamp_idx
+                                            ON follower_history (timestamp); """
+
+    sql_create_follower_history_rollup_table = """ CREATE TABLE IF NOT EXISTS follower_history_rollup (
+                                                    period text NOT NULL,
+                                                    id integer NOT NULL,
+                                                    period_start text NOT NULL,
+                                                    samples integer,
+                                                    min_followers_count integer,
+                                                    max_followers_count integer,
+                                                    followers_count integer,
+                                                    friends_count integer,
+                                                    PRIMARY KEY (period, id, period_start)
+                                                ) WITHOUT ROWID; """
+
+    sql_create_account_history_table = """ CREATE TABLE IF NOT EXISTS account_history (
+                                            timestamp text PRIMARY KEY,
+                                            followers_count integer,
+                                            friends_count integer
+                                        ); """
+
+    sql_create_account_history_rollup_table = """ CREATE TABLE IF NOT EXISTS account_history_rollup (
+                                                    period text NOT NULL,
+                                                    period_start text NOT NULL,
+                                                    samples integer,
+                                                    min_followers_count integer,
+                                                    max_followers_count integer,
+                                                    followers_count integer,
+                                                    friends_count integer,
+                                                    PRIMARY KEY (period, period_start)
+                                                ) WITHOUT ROWID; """
+
+    sql_create_history_rollup_state_table = """ CREATE TABLE IF NOT EXISTS history_rollup_state (
+                                                name text PRIMARY KEY,
+                                                rolled_until text
+                                            ); """
+
     # create a database connection
     conn = create_connection(database)
 
@@ -72,6 +209,13 @@ def init_db():
         print("Error! cannot create the database connection.")
         return
 
+    # free pages can be reclaimed without a full vacuum. Takes effect on a new
+    # database, existing ones are converted by `python maintenance.py --vacuum`.
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # readers, including online backups, do not block the processing job and the other way around
+    conn.execute("PRAGMA journal_mode = WAL")
+
     # create tables
     # create followers table
     status = create_table(conn, sql_create_follower_table)
@@ -79,45 +223,169 @@ def init_db():
         print("Error! creation of followers table failed.")
         return
 
+    # add refresh tracking, score and change sequence to followers table created by older versions
+    status = add_column(conn, 'follower', 'last_refreshed_at', 'text') and \
+        add_column(conn, 'follower', 'score', 'real') and \
+        add_column(conn, 'follower', 'updated_seq', 'integer')
+    if not status:
+        print("Error! migration of followers table failed.")
+        return
+
+    status = create_table(conn, sql_create_follower_refresh_index) and \
+        create_table(conn, sql_create_follower_score_index) and \
+        create_table(conn, sql_create_follower_updated_seq_index)
+    if not status:
+        print("Error! creation of followers indexes failed.")
+        return
+
+    # create followers full text index, populated from existing followers on creation
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'follower_fts'")
+    if cur.fetchone() is None:
+        status = create_table(conn, sql_create_follower_fts_table)
+        if not status:
+            print("Error! creation of followers full text index failed.")
+            return
+
+        cur.execute("INSERT INTO follower_fts(follower_fts) VALUES ('rebuild')")
+        conn.commit()
+
+    for sql_create_follower_fts_trigger in sql_create_follower_fts_triggers:
+        status = create_table(conn, sql_create_follower_fts_trigger)
+        if not status:
+            print("Error! creation of followers full text index triggers failed.")
+            return
+
+    # create scoring state table
+    status = create_table(conn, sql_create_scoring_state_table)
+    if not status:
+        print("Error! creation of scoring state table failed.")
+        return
+
     # create dm status table
     status = create_table(conn, sql_create_dm_status_table)
     if not status:
         print("Error! creation of dm status table failed.")
         return
 
+    # add template variant to dm status table created by older versions
+    status = add_column(conn, 'dm_status', 'variant', 'integer')
+    if not status:
+        print("Error! migration of dm status table failed.")
+        return
+
+    # create dm outbox table
+    status = create_table(conn, sql_create_dm_outbox_table)
+    if not status:
+        print("Error! creation of dm outbox table failed.")
+        return
+
     # create skip user table
     status = create_table(conn, sql_create_skip_user_table)
     if not status:
         print("Error! creation of skip user table failed.")
         return
 
+    # a follower is skipped once and a DM is recorded once
+    status = create_unique_index(conn, 'skip_user_id_idx', 'skip_user', ['id']) and \
+        create_unique_index(conn, 'dm_status_id_timestamp_idx', 'dm_status', ['id', 'timestamp'])
+    if not status:
+        print("Error! creation of unique indexes failed.")
+        return
+
+    # create follower history tables
+    for sql_create_history in [sql_create_follower_history_table,
+                               sql_create_follower_history_index,
+                               sql_create_follower_history_rollup_table,
+                               sql_create_account_history_table,
+                               sql_create_account_history_rollup_table,
+                               sql_create_history_rollup_state_table]:
+        status = create_table(conn, sql_create_history)
+        if not status:
+            print("Error! creation of follower history tables failed.")
+            return
+
     return conn
 
 
-def insert_follower(conn, follower):
+def upsert_followers(conn, followers):
     """
-    Add a new follower into db if not already present
+    Add new followers into db or update the stored profile of existing ones.
+    New followers and followers whose profile changed get the next change sequence.
     :param conn: DB Connection object
-    :param follower: follower information
-    :return: True is new follower is added else False
+    :param followers: list of follower information including refresh timestamp
+    :return: None
     """
+    cur = conn.cursor()
+    cur.execute("SELECT coalesce(max(updated_seq), 0) + 1 FROM follower")
+    updated_seq = cur.fetchone()[0]
+
+    # SET expressions see the stored profile, so updated_seq moves only when a field changes
+    sql = '''INSERT INTO follower(id, name, created_at, description,
+                 followers_count, friends_count, verified, last_refreshed_at, updated_seq)
+                 VALUES(?,?,?,?,?,?,?,?,?)
+                 ON CONFLICT(id) DO UPDATE SET
+                 name = excluded.name,
+                 created_at = excluded.created_at,
+                 description = excluded.description,
+                 followers_count = excluded.followers_count,
+                 friends_count = excluded.friends_count,
+                 verified = excluded.verified,
+                 last_refreshed_at = excluded.last_refreshed_at,
+                 updated_seq = CASE WHEN name IS NOT excluded.name
+                                      OR created_at IS NOT excluded.created_at
+                                      OR description IS NOT excluded.description
+                                      OR followers_count IS NOT excluded.followers_count
+                                      OR friends_count IS NOT excluded.friends_count
+                                      OR verified IS NOT excluded.verified
+                               THEN excluded.updated_seq ELSE updated_seq END'''
+    cur.executemany(sql, [tuple(follower) + (updated_seq,) for follower in followers])
 
-    current_follower = query_follower_by_id(conn, follower[0])
+    # commit change
+    conn.commit()
 
-    if current_follower is not None:
-        print(f"Follower with id {follower[0]} already exists")
-        return False
 
-    sql = '''INSERT INTO follower(id, name, created_at, description, 
-                 followers_count, friends_count, verified)
-                 VALUES(?,?,?,?,?,?,?)'''
+def mark_followers_refreshed(conn, ids, timestamp):
+    """
+    Set refresh timestamp of followers, also for followers twitter did not return
+    :param conn: DB Connection object
+    :param ids: follower ids
+    :param timestamp: refresh timestamp
+    :return: None
+    """
+    sql = "UPDATE follower SET last_refreshed_at = ? WHERE id = ?"
     cur = conn.cursor()
-    cur.execute(sql, follower)
+    cur.executemany(sql, [(timestamp, id) for id in ids])
 
     # commit change
     conn.commit()
 
-    return True
+
+def query_stale_follower_ids(conn, stale_before, candidate_query, limit):
+    """
+    Query ids of followers not refreshed since stale_before. Followers matching
+    candidate_query which can still receive a DM come first, then the least
+    recently refreshed.
+    :param conn: the Connection object
+    :param stale_before: refresh timestamp before which a profile is stale
+    :param candidate_query: SQL query, SQL values selecting DM candidates
+    :param limit: maximum number of ids
+    :return: list of follower ids
+    """
+    sql = f'''SELECT id FROM follower
+              WHERE (last_refreshed_at IS NULL OR last_refreshed_at < ?)
+                AND id NOT IN (SELECT id FROM skip_user)
+              ORDER BY id IN (SELECT id FROM ({candidate_query[0]})
+                              WHERE id NOT IN (SELECT id FROM dm_status
+                                               GROUP BY id HAVING count(*) > 1)) DESC,
+                       last_refreshed_at
+              LIMIT ?'''
+    cur = conn.cursor()
+    cur.execute(sql, (stale_before,) + tuple(candidate_query[1]) + (limit,))
+
+    rows = cur.fetchall()
+
+    return [row[0] for row in rows]
 
 
 def query_follower_by_id(conn, id):
@@ -135,59 +403,113 @@ def query_follower_by_id(conn, id):
     return row
 
 
-def insert_dm_status(conn, follower):
+def query_dm_status_by_id(conn, id):
     """
-    Add dm status into db
+    Query dm status by id
+    :param conn: the Connection object
+    :param id: follower id
+    :return: dm status information
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM dm_status WHERE id=?", (id,))
+
+    row = cur.fetchall()
+
+    return row
+
+
+def query_dm_counts(conn):
+    """
+    Query number of DMs sent per follower
+    :param conn: the Connection object
+    :return: dict of follower id to dm count
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT id, count(*) FROM dm_status GROUP BY id")
+
+    return dict(cur.fetchall())
+
+
+def replace_dm_outbox(conn, messages):
+    """
+    Replace pending DMs in outbox with freshly rendered messages
     :param conn: DB Connection object
-    :param follower: follower information
-    :return:
+    :param messages: list of (id, retry, variant, body, created_at)
+    :return: None
     """
-    sql = '''INSERT INTO dm_status(id, timestamp)
-                 VALUES(?,?)'''
     cur = conn.cursor()
-    cur.execute(sql, follower)
+    cur.execute("DELETE FROM dm_outbox")
+    cur.executemany('''INSERT INTO dm_outbox(id, retry, variant, body, created_at)
+                       VALUES(?,?,?,?,?)''', messages)
 
     # commit change
     conn.commit()
 
 
-def query_dm_status_by_id(conn, id):
+def query_dm_outbox(conn):
     """
-    Query dm status by id
+    Query pending DMs in outbox
     :param conn: the Connection object
-    :param id: follower id
-    :return: dm status information
+    :return: list of (id, retry, variant, body)
     """
     cur = conn.cursor()
-    cur.execute("SELECT * FROM dm_status WHERE id=?", (id,))
+    cur.execute("SELECT id, retry, variant, body FROM dm_outbox ORDER BY rowid")
 
-    row = cur.fetchall()
+    return cur.fetchall()
 
-    return row
 
+def complete_dm_outbox(conn, id, timestamp):
+    """
+    Move a sent DM from outbox into dm status
+    :param conn: DB Connection object
+    :param id: follower id
+    :param timestamp: DM sent timestamp
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.execute('''INSERT INTO dm_status(id, timestamp, variant)
+                   SELECT id, ?, variant FROM dm_outbox WHERE id = ?
+                   ON CONFLICT(id, timestamp) DO NOTHING''', (timestamp, id))
+    cur.execute("DELETE FROM dm_outbox WHERE id = ?", (id,))
 
-def insert_skip_user(conn, user):
+    # commit change
+    conn.commit()
+
+
+def delete_dm_outbox(conn, id):
     """
-    Add a new follower into db if not already present
+    Drop a pending DM from outbox
     :param conn: DB Connection object
-    :param user: skip user information
-    :return: True is new follower is added else False
+    :param id: follower id
+    :return: None
     """
+    cur = conn.cursor()
+    cur.execute("DELETE FROM dm_outbox WHERE id = ?", (id,))
 
-    current_follower = query_follower_by_id(conn, user[0])
+    # commit change
+    conn.commit()
 
-    if current_follower is not None:
-        print(f"Skip user with id {user[0]} already exists")
-        return False
 
+def insert_skip_user(conn, user):
+    """
+    Add a new skip user into db if not already present
+    :param conn: DB Connection object
+    :param user: skip user information
+    :return: True is new skip user is added else False
+    """
     sql = '''INSERT INTO skip_user(id, timestamp)
-                 VALUES(?,?)'''
+                 VALUES(?,?)
+                 ON CONFLICT(id) DO NOTHING'''
     cur = conn.cursor()
     cur.execute(sql, user)
 
     # commit change
     conn.commit()
 
+    if not cur.rowcount:
+        print(f"Skip user with id {user[0]} already exists")
+        return False
+
     return True
 
 
@@ -219,6 +541,60 @@ def get_all_records(table_name):
     return df
 
 
+def get_records_by_ids(table_name, ids):
+    """
+    Get records of the given follower ids
+    :param table_name: table name
+    :param ids: follower ids
+    :return: Data Frame of records
+    """
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query(f"SELECT * FROM {table_name} WHERE id IN (SELECT value FROM json_each(?))",
+                           conn, params=(json.dumps([int(id) for id in ids]),))
+    conn.close()
+
+    return df
+
+
+def get_high_water_marks():
+    """
+    Get last change sequence of followers and last rowid of dm status, every change
+    to a follower shown on the dashboard moves one of them
+    :return: dict of table name to high water mark
+    """
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+
+    cur.execute("SELECT coalesce(max(updated_seq), 0) FROM follower")
+    high_water_marks = {'follower': cur.fetchone()[0]}
+
+    cur.execute("SELECT coalesce(max(rowid), 0) FROM dm_status")
+    high_water_marks['dm_status'] = cur.fetchone()[0]
+
+    conn.close()
+
+    return high_water_marks
+
+
+def get_changed_follower_ids(high_water_marks):
+    """
+    Get ids of followers changed after the given high water marks
+    :param high_water_marks: dict of table name to last seen high water mark
+    :return: list of follower ids
+    """
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    cur.execute('''SELECT id FROM follower WHERE updated_seq > ?
+                   UNION
+                   SELECT id FROM dm_status WHERE rowid > ?''',
+                (high_water_marks['follower'], high_water_marks['dm_status']))
+
+    rows = cur.fetchall()
+    conn.close()
+
+    return [row[0] for row in rows]
+
+
 def get_high_value_followers():
     """ Fetch high value follower information.
     :return: Data Frame of high value follower details
@@ -0,0 +1,128 @@
+from functools import lru_cache
+from string import Formatter
+import zlib
+
+from config import message, retry_message, dm_message_templates, dm_retry_message_templates
+
+
+def legacy_template(dm):
+    """ Build template from a plain DM, greeting the follower by name.
+    :param dm: plain DM text
+    :return: template string
+    """
+    return "Hi {name},\n" + dm.replace('{', '{{').replace('}', '}}')
+
+
+def get_templates(retry):
+    """ Get configured DM template variants.
+    :param retry: True for retry message templates
+    :return: tuple of template strings
+    """
+    if retry:
+        return tuple(dm_retry_message_templates) or (legacy_template(retry_message),)
+
+    return tuple(dm_message_templates) or (legacy_template(message),)
+
+
+@lru_cache(maxsize=None)
+def compile_templates(templates, columns):
+    """ Compile template variants into positional format strings for rows with the given columns.
+    :param templates: tuple of template strings with {column} placeholders
+    :param columns: tuple of row column names
+    :return: tuple of compiled format strings, None if a template uses an unknown placeholder
+    """
+    compiled_templates = []
+
+    for template in templates:
+        parts = []
+
+        try:
+            parsed_template = list(Formatter().parse(template))
+        except ValueError as e:
+            print(f"Error: Invalid DM template {template!r}: {str(e)}.")
+            return None
+
+        for literal, field, format_spec, conversion in parsed_template:
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+
+            if field is None:
+                continue
+
+            if field not in columns:
+                print(f"Error: Unknown placeholder {{{field}}} in DM template. "
+                      f"Available placeholders: {', '.join(columns)}.")
+                return None
+
+            # rows are formatted positionally, placeholders nested in format spec can not be filled
+            if format_spec and any(nested_field is not None
+                                   for _, nested_field, _, _ in Formatter().parse(format_spec)):
+                print(f"Error: Placeholder in format spec of {{{field}:{format_spec}}} in DM template "
+                      f"is not supported.")
+                return None
+
+            part = '{' + str(columns.index(field))
+            if conversion:
+                part = part + '!' + conversion
+            if format_spec:
+                part = part + ':' + format_spec
+            parts.append(part + '}')
+
+        compiled_templates.append(''.join(parts))
+
+    return tuple(compiled_templates)
+
+
+def validate_templates(columns, sample_row):
+    """ Check DM and retry DM templates only use placeholders of the given columns,
+    and render them with a sample row to catch invalid conversions and format specs.
+    :param columns: column names available to templates
+    :param sample_row: row with a typical value of each column
+    :return: True if all templates can be rendered else False
+    """
+    for retry in (False, True):
+        compiled_templates = compile_templates(get_templates(retry), tuple(columns))
+        if compiled_templates is None:
+            return False
+
+        for template, compiled_template in zip(get_templates(retry), compiled_templates):
+            try:
+                compiled_template.format(*sample_row)
+            except (ValueError, TypeError) as e:
+                print(f"Error: Invalid DM template {template!r}: {str(e)}.")
+                return False
+
+    return True
+
+
+def render_messages(rows, columns, retry_list):
+    """ Render DMs in bulk. Variant is picked by hash of follower id so a follower always gets the same variant.
+    :param rows: follower rows
+    :param columns: column names of the rows, including id
+    :param retry_list: per row flag to render retry message
+    :return: list of (id, retry, variant, body), None if templates can not be compiled.
+    Followers whose DM can not be rendered, e.g. formatting a missing value, are left out.
+    """
+    columns = tuple(columns)
+
+    compiled_templates = {retry: compile_templates(get_templates(retry), columns)
+                          for retry in (False, True)}
+    if None in compiled_templates.values():
+        return None
+
+    id_index = columns.index('id')
+    messages = []
+
+    for row, retry in zip(rows, retry_list):
+        variants = compiled_templates[retry]
+        # low bits of twitter ids are mostly 0, hash the id for an even split
+        variant = zlib.crc32(str(row[id_index]).encode()) % len(variants)
+
+        try:
+            body = variants[variant].format(*row)
+        except (ValueError, TypeError) as e:
+            print(f"Error: DM for follower {row[id_index]} can not be rendered: {str(e)}. Follower skipped.")
+            continue
+
+        messages.append((row[id_index], int(retry), variant, body))
+
+    return messages
@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta
+import pandas as pd
+import sqlite3
+
+from db import init_db
+from config import db_file, history_raw_retention_days, history_daily_retention_days
+
+
+# SQL expression mapping a raw sample timestamp onto the start of its rollup period.
+# Weeks start on Monday.
+rollup_periods = {
+    'day': "date(timestamp)",
+    'week': "date(timestamp, 'weekday 0', '-6 days')",
+}
+
+# Milliseconds to wait for the processing job's write transactions before giving up
+rollup_busy_timeout = 30000
+
+
+def insert_follower_history(conn, history_list):
+    """
+    Append follower metrics into history. A sample is only written when
+    followers or friends count differs from the last sample of the follower.
+    :param conn: DB Connection object
+    :param history_list: list of (id, timestamp, followers_count, friends_count)
+    :return: None
+    """
+    sql = '''INSERT OR IGNORE INTO follower_history(id, timestamp, followers_count, friends_count)
+                 SELECT :id, :timestamp, :followers_count, :friends_count
+                 WHERE NOT EXISTS (
+                     SELECT 1 FROM (SELECT followers_count, friends_count FROM follower_history
+                                    WHERE id = :id ORDER BY timestamp DESC LIMIT 1) AS last
+                     WHERE last.followers_count IS :followers_count
+                       AND last.friends_count IS :friends_count)'''
+
+    params = [{'id': history[0], 'timestamp': history[1],
+               'followers_count': history[2], 'friends_count': history[3]}
+              for history in history_list]
+
+    cur = conn.cursor()
+    cur.executemany(sql, params)
+
+    # commit change
+    conn.commit()
+
+
+def insert_account_history(conn, history):
+    """
+    Append account metrics into history if they changed since the last sample.
+    :param conn: DB Connection object
+    :param history: (timestamp, followers_count, friends_count)
+    :return: None
+    """
+    sql = '''INSERT OR IGNORE INTO account_history(timestamp, followers_count, friends_count)
+                 SELECT ?, ?, ?
+                 WHERE NOT EXISTS (
+                     SELECT 1 FROM (SELECT followers_count, friends_count FROM account_history
+                                    ORDER BY timestamp DESC LIMIT 1) AS last
+                     WHERE last.followers_count IS ? AND last.friends_count IS ?)'''
+    cur = conn.cursor()
+    cur.execute(sql, history + history[1:])
+
+    # commit change
+    conn.commit()
+
+
+def rollup_history(conn):
+    """
+    Aggregate raw follower and account history into daily and weekly rollups.
+    Only periods touched since the previous rollup are recomputed.
+    :param conn: DB Connection object
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT rolled_until FROM history_rollup_state WHERE name = 'history'")
+    row = cur.fetchone()
+
+    # recompute from the start of the week holding the previous rollup,
+    # which also covers the day holding it
+    since = ''
+    if row is not None:
+        cur.execute(f"SELECT {rollup_periods['week']} FROM (SELECT ? AS timestamp)", (row[0],))
+        since = cur.fetchone()[0]
+
+    rolled_until = str(datetime.now())[:-3]
+
+    for period, period_start in rollup_periods.items():
+        cur.execute(f'''INSERT OR REPLACE INTO follower_history_rollup(period, id, period_start, samples,
+                                min_followers_count, max_followers_count, followers_count, friends_count)
+                            SELECT ?, id, period_start, count(*), min(followers_count), max(followers_count),
+                                   last_followers_count, last_friends_count
+                            FROM (SELECT id, followers_count, {period_start} AS period_start,
+                                         last_value(followers_count) OVER w AS last_followers_count,
+                                         last_value(friends_count) OVER w AS last_friends_count
+                                  FROM follower_history
+                                  WHERE timestamp >= ?
+                                  WINDOW w AS (PARTITION BY id, {period_start} ORDER BY timestamp
+                                               ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING))
+                            GROUP BY id, period_start''', (period, since))
+
+        cur.execute(f'''INSERT OR REPLACE INTO account_history_rollup(period, period_start, samples,
+                                min_followers_count, max_followers_count, followers_count, friends_count)
+                            SELECT ?, period_start, count(*), min(followers_count), max(followers_count),
+                                   last_followers_count, last_friends_count
+                            FROM (SELECT followers_count, {period_start} AS period_start,
+                                         last_value(followers_count) OVER w AS last_followers_count,
+                                         last_value(friends_count) OVER w AS last_friends_count
+                                  FROM account_history
+                                  WHERE timestamp >= ?
+                                  WINDOW w AS (PARTITION BY {period_start} ORDER BY timestamp
+                                               ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING))
+                            GROUP BY period_start''', (period, since))
+
+    cur.execute("INSERT OR REPLACE INTO history_rollup_state(name, rolled_until) VALUES('history', ?)",
+                (rolled_until,))
+
+    # commit change
+    conn.commit()
+
+
+def prune_history(conn, raw_retention_days, daily_retention_days):
+    """
+    Apply retention policy on history. Raw samples and daily rollups older than
+    their retention are deleted, weekly rollups are kept.
+    :param conn: DB Connection object
+    :param raw_retention_days: days raw samples are kept
+    :param daily_retention_days: days daily rollups are kept
+    :return: None
+    """
+    now = datetime.now()
+    raw_cutoff = str(now - timedelta(days=raw_retention_days))[:-3]
+    daily_cutoff = str((now - timedelta(days=daily_retention_days)).date())
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM follower_history WHERE timestamp < ?", (raw_cutoff,))
+    cur.execute("DELETE FROM account_history WHERE timestamp < ?", (raw_cutoff,))
+    cur.execute("DELETE FROM follower_history_rollup WHERE period = 'day' AND period_start < ?",
+                (daily_cutoff,))
+    cur.execute("DELETE FROM account_history_rollup WHERE period = 'day' AND period_start < ?",
+                (daily_cutoff,))
+
+    # commit change
+    conn.commit()
+
+
+def trigger_history_rollup():
+    """ Roll up follower history and apply retention policy.
+    :return: None
+    """
+    print("Triggering follower history rollup")
+
+    conn = None
+    try:
+        conn = init_db()
+        if conn is None:
+            return
+
+        conn.execute(f"PRAGMA busy_timeout = {rollup_busy_timeout}")
+
+        rollup_history(conn)
+        prune_history(conn, history_raw_retention_days, history_daily_retention_days)
+    except sqlite3.Error as e:
+        # e.g. database locked by follower processing, retried on next run
+        print(f"Error! follower history rollup failed: {str(e)}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def get_account_growth(period):
+    """
+    Get account followers and friends count over time from rollups
+    :param period: rollup period, 'day' or 'week'
+    :return: Data Frame of account growth
+    """
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query('''SELECT period_start, min_followers_count, max_followers_count,
+                                     followers_count, friends_count
+                              FROM account_history_rollup
+                              WHERE period = ?
+                              ORDER BY period_start''', conn, params=(period,))
+
+    return df
+
+
+def get_follower_trajectory(id, period):
+    """
+    Get followers and friends count of a follower over time from rollups
+    :param id: follower id
+    :param period: rollup period, 'day' or 'week'
+    :return: Data Frame of follower trajectory
+    """
+    conn = sqlite3.connect(db_file)
+    df = pd.read_sql_query('''SELECT period_start, min_followers_count, max_followers_count,
+                                     followers_count, friends_count
+                              FROM follower_history_rollup
+                              WHERE period = ? AND id = ?
+                              ORDER BY period_start''', conn, params=(period, id))
+
+    return df
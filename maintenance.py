@@ -0,0 +1,171 @@
+import argparse
+import time
+import sqlite3
+
+from db import init_db
+from metrics import record_timing
+from twitter import build_filter_query, build_dispatch_query
+
+
+# Milliseconds to wait for the processing job's write transactions before giving up
+maintenance_busy_timeout = 30000
+
+# Approximate rows scanned per index by ANALYZE, keeps it short on large tables
+maintenance_analysis_limit = 1000
+
+
+def get_report_queries():
+    """ Get queries of follower processing whose query plans are reported by maintenance.
+    :return: list of (name, SQL query, SQL values)
+    """
+    filter_query = build_filter_query()
+    dispatch_query = build_dispatch_query(1000)
+
+    return [
+        ("filter followers", filter_query[0], filter_query[1]),
+        ("dispatch followers", dispatch_query[0], dispatch_query[1]),
+        ("dm status by id", "SELECT * FROM dm_status WHERE id=?", (0,)),
+        ("skip user by id", "SELECT * FROM skip_user WHERE id=?", (0,)),
+        ("dm counts", "SELECT id, count(*) FROM dm_status GROUP BY id", ()),
+        ("stale followers", "SELECT id FROM follower WHERE last_refreshed_at IS NULL OR last_refreshed_at < ? "
+                            "ORDER BY last_refreshed_at", ('',)),
+    ]
+
+
+def get_query_plans(conn):
+    """ Get query plans of tracked queries.
+    :param conn: Connection object
+    :return: dict of query name to query plan
+    """
+    cur = conn.cursor()
+    query_plans = {}
+
+    for name, sql, values in get_report_queries():
+        cur.execute("EXPLAIN QUERY PLAN " + sql, values)
+        query_plans[name] = '; '.join(row[3] for row in cur.fetchall())
+
+    return query_plans
+
+
+def get_storage_stats(conn):
+    """ Get page counts of the database and, when dbstat is available, of each table.
+    :param conn: Connection object
+    :return: dict of page_count, freelist_count and table_pages
+    """
+    cur = conn.cursor()
+
+    storage_stats = {
+        'page_count': cur.execute("PRAGMA page_count").fetchone()[0],
+        'freelist_count': cur.execute("PRAGMA freelist_count").fetchone()[0],
+        'table_pages': {},
+    }
+
+    try:
+        cur.execute("SELECT name, count(*) FROM dbstat GROUP BY name")
+        storage_stats['table_pages'] = dict(cur.fetchall())
+    except sqlite3.Error:
+        pass
+
+    return storage_stats
+
+
+def run_maintenance(conn, convert=False):
+    """ Reclaim free pages and refresh planner statistics.
+    Databases not yet in incremental auto vacuum mode need a one time full vacuum, which
+    blocks all writers, so it only runs when asked for with the application stopped.
+    :param conn: Connection object
+    :param convert: True to convert the database to incremental auto vacuum
+    :return: report dict with storage stats and query plans before and after
+    """
+    storage_before = get_storage_stats(conn)
+    plans_before = get_query_plans(conn)
+
+    cur = conn.cursor()
+    auto_vacuum = cur.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+    # 2: INCREMENTAL
+    if auto_vacuum == 2:
+        cur.execute("PRAGMA incremental_vacuum").fetchall()
+    elif convert:
+        print("Converting database to incremental auto vacuum.")
+        conn.commit()
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("VACUUM")
+    else:
+        print("Info: Free pages are not reclaimed. Stop the application and run "
+              "`python maintenance.py --vacuum` once to convert the database to incremental auto vacuum.")
+
+    cur.execute(f"PRAGMA analysis_limit = {maintenance_analysis_limit}")
+    cur.execute("ANALYZE")
+    conn.commit()
+
+    storage_after = get_storage_stats(conn)
+    plans_after = get_query_plans(conn)
+
+    return {
+        'storage_before': storage_before,
+        'storage_after': storage_after,
+        'plans_before': plans_before,
+        'plans_after': plans_after,
+    }
+
+
+def print_maintenance_report(report):
+    """ Print reclaimed pages and query plan changes.
+    :param report: report dict from run_maintenance
+    :return: None
+    """
+    storage_before = report['storage_before']
+    storage_after = report['storage_after']
+
+    print(f"Reclaimed {storage_before['page_count'] - storage_after['page_count']} pages "
+          f"({storage_before['page_count']} -> {storage_after['page_count']}), "
+          f"free pages {storage_before['freelist_count']} -> {storage_after['freelist_count']}.")
+
+    for table_name, pages in sorted(storage_after['table_pages'].items()):
+        pages_before = storage_before['table_pages'].get(table_name, 0)
+        if pages != pages_before:
+            print(f"  {table_name}: {pages_before} -> {pages} pages")
+
+    for name, plan in report['plans_after'].items():
+        if plan != report['plans_before'][name]:
+            print(f"Query plan of {name} changed: {report['plans_before'][name]} -> {plan}")
+
+
+def trigger_maintenance(convert=False):
+    """ Run database maintenance and print its report.
+    :param convert: True to convert the database to incremental auto vacuum
+    :return: None
+    """
+    print("Triggering database maintenance")
+
+    conn = None
+    try:
+        conn = init_db()
+        if conn is None:
+            return
+
+        conn.execute(f"PRAGMA busy_timeout = {maintenance_busy_timeout}")
+
+        start_time = time.perf_counter()
+        report = run_maintenance(conn, convert)
+        record_timing("maintenance", time.perf_counter() - start_time)
+
+        print_maintenance_report(report)
+    except sqlite3.Error as e:
+        # e.g. database locked by follower processing, retried on next run
+        print(f"Error! database maintenance failed: {str(e)}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run twitter export database maintenance.")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="Convert database to incremental auto vacuum with a full vacuum. "
+                             "Stop the application before converting.")
+
+    args = parser.parse_args()
+
+    trigger_maintenance(args.vacuum)
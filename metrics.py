@@ -0,0 +1,45 @@
+import threading
+
+
+# Timings collected in this process, keyed by metric name
+timings = {}
+timings_lock = threading.Lock()
+
+
+def record_timing(name, seconds):
+    """ Record duration of an operation.
+    :param name: metric name
+    :param seconds: duration in seconds
+    :return: None
+    """
+    with timings_lock:
+        timing = timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+        timing['last'] = seconds
+
+
+def get_timings(prefix=''):
+    """ Get collected timings.
+    :param prefix: only return metrics whose name starts with prefix
+    :return: dict of metric name to count, total, max and last duration in seconds
+    """
+    with timings_lock:
+        return {name: dict(timing) for name, timing in timings.items() if name.startswith(prefix)}
+
+
+def summarize_timings(prefix=''):
+    """ Summarize collected timings as count and average duration.
+    :param prefix: only summarize metrics whose name starts with prefix
+    :return: (count, average duration in milliseconds)
+    """
+    selected_timings = get_timings(prefix).values()
+
+    count = sum(timing['count'] for timing in selected_timings)
+    total = sum(timing['total'] for timing in selected_timings)
+
+    if not count:
+        return 0, 0.0
+
+    return count, total * 1000 / count
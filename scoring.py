@@ -0,0 +1,146 @@
+from datetime import datetime
+import json
+import numpy as np
+import pandas as pd
+
+from config import scoring_weights, scoring_keywords
+
+
+def compute_scores(followers_count, friends_count, created_at, verified, keyword_matches, dm_count, now):
+    """ Compute weighted follower scores in one vectorized pass.
+    :param followers_count: array of followers count
+    :param friends_count: array of friends count
+    :param created_at: datetime64 array of twitter joining date
+    :param verified: array of verified flag
+    :param keyword_matches: array of number of keywords matched in description
+    :param dm_count: array of DMs already sent
+    :param now: datetime64 of scoring time
+    :return: array of scores
+    """
+    follower_friend_ratio = np.log1p(followers_count) - np.log1p(friends_count)
+    account_age_years = np.nan_to_num((now - created_at) / np.timedelta64(1, 'D') / 365.25)
+
+    return (scoring_weights['follower_friend_ratio'] * follower_friend_ratio
+            + scoring_weights['account_age_years'] * account_age_years
+            + scoring_weights['verified'] * verified
+            + scoring_weights['keyword_match'] * keyword_matches
+            + scoring_weights['dm_count'] * dm_count)
+
+
+def query_keyword_matches(conn, ids, all_followers=False):
+    """ Count configured keywords found in description of followers using full text index.
+    :param conn: Connection object
+    :param ids: array of follower ids
+    :param all_followers: True if ids are all followers, matches are then not restricted to ids
+    :return: array of number of keywords matched
+    """
+    keyword_matches = np.zeros(len(ids))
+    cur = conn.cursor()
+
+    sql_str = "SELECT rowid FROM follower_fts WHERE follower_fts MATCH ?"
+    sql_values = ()
+
+    if not all_followers:
+        sql_str = sql_str + " AND rowid IN (SELECT value FROM json_each(?))"
+        sql_values = (json.dumps(ids.tolist()),)
+
+    for keyword in scoring_keywords:
+        # match keyword as a phrase
+        cur.execute(sql_str, ('"' + keyword.replace('"', '""') + '"',) + sql_values)
+        matched_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+        keyword_matches += np.isin(ids, matched_ids)
+
+    return keyword_matches
+
+
+def score_followers(conn, ids=None):
+    """ Compute and store scores of followers.
+    :param conn: Connection object
+    :param ids: follower ids to score, all followers if None
+    :return: None
+    """
+    sql_str = "SELECT id, created_at, followers_count, friends_count, verified FROM follower"
+    sql_dm_str = "SELECT id, count(*) AS dm_count FROM dm_status"
+    sql_values = ()
+
+    if ids is not None:
+        if len(ids) == 0:
+            return
+
+        sql_str = sql_str + " WHERE id IN (SELECT value FROM json_each(?))"
+        sql_dm_str = sql_dm_str + " WHERE id IN (SELECT value FROM json_each(?))"
+        sql_values = (json.dumps([int(id) for id in ids]),)
+
+    follower_df = pd.read_sql_query(sql_str, conn, params=sql_values)
+    dm_count_df = pd.read_sql_query(sql_dm_str + " GROUP BY id", conn, params=sql_values)
+
+    follower_ids = follower_df['id'].to_numpy(dtype=np.int64)
+    dm_count = dm_count_df.set_index('id')['dm_count'].reindex(follower_ids, fill_value=0).to_numpy()
+
+    scores = compute_scores(follower_df['followers_count'].fillna(0).to_numpy(dtype=np.float64),
+                            follower_df['friends_count'].fillna(0).to_numpy(dtype=np.float64),
+                            pd.to_datetime(follower_df['created_at']).to_numpy(),
+                            follower_df['verified'].fillna(0).to_numpy(dtype=np.float64),
+                            query_keyword_matches(conn, follower_ids, all_followers=ids is None),
+                            dm_count,
+                            np.datetime64(datetime.now()))
+
+    cur = conn.cursor()
+    cur.executemany("UPDATE follower SET score = ? WHERE id = ?",
+                    zip(scores.tolist(), follower_ids.tolist()))
+
+    # commit change
+    conn.commit()
+
+
+def score_users(user_df, dm_counts):
+    """ Compute scores of users not stored in the database, like test accounts.
+    Keywords are matched case insensitive in the description instead of using the full text index.
+    :param user_df: Data Frame of user details
+    :param dm_counts: dict of user id to DMs already sent
+    :return: array of scores
+    """
+    descriptions = user_df['description'].fillna('').str.lower()
+    keyword_matches = np.zeros(len(user_df))
+    for keyword in scoring_keywords:
+        keyword_matches += descriptions.str.contains(keyword.lower(), regex=False).to_numpy()
+
+    return compute_scores(user_df['followers_count'].fillna(0).to_numpy(dtype=np.float64),
+                          user_df['friends_count'].fillna(0).to_numpy(dtype=np.float64),
+                          pd.to_datetime(user_df['created_at']).to_numpy(),
+                          user_df['verified'].fillna(0).to_numpy(dtype=np.float64),
+                          keyword_matches,
+                          np.array([dm_counts.get(id, 0) for id in user_df['id']], dtype=np.float64),
+                          np.datetime64(datetime.now()))
+
+
+def get_scoring_fingerprint():
+    """ Get fingerprint of scoring configuration, scores are recomputed when it changes.
+    :return: fingerprint string
+    """
+    return json.dumps({'weights': scoring_weights, 'keywords': scoring_keywords}, sort_keys=True)
+
+
+def ensure_follower_scores(conn):
+    """ Score all followers if scoring configuration changed since last full scoring,
+    else score followers without score.
+    :param conn: Connection object
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT fingerprint FROM scoring_state WHERE name = 'follower'")
+    row = cur.fetchone()
+
+    fingerprint = get_scoring_fingerprint()
+
+    if row is None or row[0] != fingerprint:
+        print("Scoring all followers.")
+        score_followers(conn)
+
+        cur.execute("INSERT OR REPLACE INTO scoring_state(name, fingerprint) VALUES('follower', ?)",
+                    (fingerprint,))
+        conn.commit()
+
+    else:
+        cur.execute("SELECT id FROM follower WHERE score IS NULL")
+        score_followers(conn, [row[0] for row in cur.fetchall()])
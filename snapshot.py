@@ -0,0 +1,264 @@
+from datetime import datetime
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from config import db_file
+from db import get_all_records
+from metrics import record_timing
+
+
+# Pointer file naming the current snapshot directory, replaced atomically on publish
+snapshot_pointer_file = db_file + '.snapshot'
+
+# Text columns plotted by the dashboard, stored as fixed width unicode arrays numpy memory maps
+# without decoding. Twitter names are at most 50 characters.
+fixed_width_columns = ['name']
+
+# Decoded columns of the current snapshot, kept across dashboard refreshes
+snapshot_cache = {'directory': None, 'meta': None, 'columns': {}}
+snapshot_cache_lock = threading.Lock()
+
+
+def write_string_column(path, values):
+    """ Write strings as one UTF-8 buffer with character offsets and validity mask.
+    :param path: column file path without extension
+    :param values: Series of strings or None
+    :return: None
+    """
+    valid = values.notna().to_numpy()
+    strings = values.fillna('').tolist()
+
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+
+    np.save(path + '.data.npy', np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8))
+    np.save(path + '.offsets.npy', offsets)
+    np.save(path + '.valid.npy', valid)
+
+
+def read_string_column(path):
+    """ Read strings written by write_string_column.
+    :param path: column file path without extension
+    :return: object array of strings or None
+    """
+    text = np.load(path + '.data.npy', mmap_mode='r').tobytes().decode('utf-8')
+    offsets = np.load(path + '.offsets.npy', mmap_mode='r').tolist()
+    valid = np.load(path + '.valid.npy', mmap_mode='r')
+
+    strings = np.array([text[start:end] for start, end in zip(offsets[:-1], offsets[1:])], dtype=object)
+    strings[~valid] = None
+
+    return strings
+
+
+def remove_stale_snapshots(directory=None):
+    """ Remove snapshot directories other than the given one, including unpublished
+    directories left by an interrupted publish.
+    :param directory: snapshot directory to keep
+    :return: None
+    """
+    # open memory maps of removed snapshots stay valid
+    for old_directory in glob.glob(f"{db_file}.snapshot-*"):
+        if old_directory != directory:
+            shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def publish_follower_snapshot():
+    """ Write columnar snapshot of follower table next to the database.
+    Numeric and date columns are .npy files the dashboard memory maps. The snapshot is
+    written into a new directory and published by atomically replacing the pointer file.
+    Followers changed later are found by their change sequence.
+    :return: number of followers in the snapshot
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        # read high water mark and followers from the same database snapshot
+        conn.execute("BEGIN")
+        updated_seq = conn.execute("SELECT coalesce(max(updated_seq), 0) FROM follower").fetchone()[0]
+        follower_df = pd.read_sql_query("SELECT * FROM follower ORDER BY id", conn)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    current_time = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    directory = f"{db_file}.snapshot-{current_time}"
+    tmp_directory = directory + '.tmp'
+
+    try:
+        os.makedirs(tmp_directory)
+
+        string_columns = []
+        for column in follower_df.columns:
+            path = os.path.join(tmp_directory, column)
+
+            if column == 'created_at':
+                created_at = pd.to_datetime(follower_df[column], format='%Y-%m-%d %H:%M:%S')
+                np.save(path + '.npy', created_at.to_numpy(dtype='datetime64[s]'))
+            elif column in fixed_width_columns:
+                np.save(path + '.npy', np.array(follower_df[column].fillna('').tolist(), dtype=str))
+            elif follower_df[column].dtype == object:
+                write_string_column(path, follower_df[column])
+                string_columns.append(column)
+            else:
+                np.save(path + '.npy', follower_df[column].to_numpy())
+
+        meta = {'updated_seq': updated_seq,
+                'row_count': len(follower_df),
+                'columns': list(follower_df.columns),
+                'string_columns': string_columns}
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        os.rename(tmp_directory, directory)
+
+        with open(snapshot_pointer_file + '.tmp', 'w') as pointer_file:
+            json.dump({'directory': os.path.basename(directory)}, pointer_file)
+        os.replace(snapshot_pointer_file + '.tmp', snapshot_pointer_file)
+
+    finally:
+        # left over only if publishing failed
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+    remove_stale_snapshots(directory)
+
+    return len(follower_df)
+
+
+def trigger_follower_snapshot():
+    """ Publish follower snapshot and record its duration in metrics.
+    Snapshot directories of an interrupted publish are removed first.
+    :return: None
+    """
+    print("Publishing follower snapshot")
+
+    start_time = time.perf_counter()
+    try:
+        remove_stale_snapshots(get_snapshot_directory())
+        follower_count = publish_follower_snapshot()
+    except (OSError, sqlite3.Error) as e:
+        # e.g. disk full or database locked, dashboard keeps the previous snapshot
+        print(f"Error! follower snapshot failed: {str(e)}")
+        return
+
+    record_timing("snapshot", time.perf_counter() - start_time)
+    print(f"Published snapshot of {follower_count} followers.")
+
+
+def get_snapshot_directory():
+    """ Get directory of the published snapshot from the pointer file.
+    :return: snapshot directory or None if there is no snapshot
+    """
+    try:
+        with open(snapshot_pointer_file) as pointer_file:
+            return os.path.join(os.path.dirname(snapshot_pointer_file), json.load(pointer_file)['directory'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_snapshot():
+    """ Get current snapshot directory and meta information, loading it if it changed.
+    :return: (directory, meta) or (None, None) if there is no snapshot
+    """
+    directory = get_snapshot_directory()
+    if directory is None:
+        return None, None
+
+    with snapshot_cache_lock:
+        if snapshot_cache['directory'] != directory:
+            try:
+                with open(os.path.join(directory, 'meta.json')) as meta_file:
+                    meta = json.load(meta_file)
+            except (OSError, ValueError):
+                return None, None
+
+            # snapshot of an older version without change sequence
+            if 'updated_seq' not in meta:
+                return None, None
+
+            snapshot_cache.update({'directory': directory, 'meta': meta, 'columns': {}})
+
+        return directory, snapshot_cache['meta']
+
+
+def get_snapshot_column(directory, meta, column):
+    """ Get a snapshot column, memory mapped for numeric, date and fixed width text columns.
+    Fixed width text is converted to str objects in numpy and other text is decoded in Python,
+    both once per snapshot.
+    :param directory: snapshot directory
+    :param meta: snapshot meta information
+    :param column: column name
+    :return: array of column values
+    """
+    with snapshot_cache_lock:
+        if snapshot_cache['directory'] == directory and column in snapshot_cache['columns']:
+            return snapshot_cache['columns'][column]
+
+    path = os.path.join(directory, column)
+    if column in meta['string_columns']:
+        values = read_string_column(path)
+    else:
+        values = np.load(path + '.npy', mmap_mode='r')
+
+        # fixed width text, pandas keeps text as str objects
+        if values.dtype.kind == 'U':
+            values = values.astype(object)
+
+    with snapshot_cache_lock:
+        if snapshot_cache['directory'] == directory:
+            snapshot_cache['columns'][column] = values
+
+    return values
+
+
+def load_followers(columns=None):
+    """ Load followers from the latest snapshot. Followers changed after the snapshot
+    are read from the database. Without a snapshot all followers are read from the database.
+    Numeric, date and name columns are memory mapped. pandas 1.x copies numeric columns into the
+    Data Frame on every call, names become str objects once per snapshot in numpy and other text
+    columns are decoded in Python on first use of a snapshot.
+    :param columns: list of follower columns, all columns if None
+    :return: Data Frame of follower details
+    """
+    directory, meta = get_snapshot()
+
+    if directory is None:
+        follower_df = get_all_records("follower")
+        return follower_df if columns is None else follower_df[columns]
+
+    if columns is None:
+        columns = meta['columns']
+
+    # changed followers are merged by id
+    load_columns = columns if 'id' in columns else ['id'] + columns
+
+    try:
+        snapshot_columns = {column: get_snapshot_column(directory, meta, column) for column in load_columns}
+    except OSError:
+        # snapshot replaced while loading
+        follower_df = get_all_records("follower")
+        return follower_df[columns]
+
+    # followers changed since the snapshot
+    conn = sqlite3.connect(db_file)
+    changed_df = pd.read_sql_query(f"SELECT {', '.join(load_columns)} FROM follower WHERE updated_seq > ?",
+                                   conn, params=(meta['updated_seq'],))
+    conn.close()
+
+    follower_df = pd.DataFrame({column: snapshot_columns[column] for column in columns}, copy=False)
+
+    if not changed_df.empty:
+        if 'created_at' in columns:
+            created_at = pd.to_datetime(changed_df['created_at'], format='%Y-%m-%d %H:%M:%S')
+            changed_df['created_at'] = created_at.to_numpy(dtype=snapshot_columns['created_at'].dtype)
+
+        unchanged = ~np.isin(snapshot_columns['id'], changed_df['id'].to_numpy())
+        follower_df = pd.concat([follower_df[unchanged], changed_df[columns]], ignore_index=True)
+
+    return follower_df
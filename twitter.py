@@ -1,17 +1,35 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import pandas as pd
 import time
 import tweepy
 
-from db import init_db, insert_follower, query_follower_by_id, insert_dm_status, query_dm_status_by_id, \
-    insert_skip_user, query_skip_user_by_id
+from db import init_db, upsert_followers, query_follower_by_id, query_dm_status_by_id, \
+    insert_skip_user, query_skip_user_by_id, mark_followers_refreshed, query_stale_follower_ids, \
+    query_dm_counts, replace_dm_outbox, query_dm_outbox, complete_dm_outbox, delete_dm_outbox
+from dm_template import render_messages, validate_templates
+from scoring import score_followers, ensure_follower_scores, score_users
+from history import insert_follower_history, insert_account_history
+from client import get_api
+from metrics import summarize_timings
 
-from config import consumer_key, consumer_secret, access_token, access_token_secret, \
-    enable_dm_flag, message, retry_message, retry_after_days, \
+from config import enable_dm_flag, retry_after_days, \
     filter_created_before, filter_min_followers_count, filter_max_followers_count,\
     filter_min_friends_count, filter_max_friends_count, filter_verified_only, \
-    test_flag, test_accounts, test_retry_message
+    test_flag, test_accounts, test_retry_message, \
+    profile_refresh_stale_after_days, profile_refresh_max_batches
+
+
+# Column names of processed user information
+user_info_columns = ['id', 'name', 'created_at', 'description',
+                     'followers_count', 'friends_count', 'verified']
+
+# Follower columns available as DM template placeholders, in live and test mode
+dm_template_columns = user_info_columns + ['last_refreshed_at', 'score']
+
+# Typical follower row of dm_template_columns, templates are test rendered with it before processing
+dm_template_sample_row = (1, 'name', '2020-01-01 00:00:00', 'description',
+                          100, 100, 0, '2020-01-01 00:00:00.000', 1.0)
 
 
 def datetime_valid(dt_str):
@@ -27,13 +45,10 @@ def get_total_follower_count():
     Fetch total follower count
     :return: Total follower count
     """
-    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_token, access_token_secret)
-
-    api = tweepy.API(auth)
+    api = get_api()
 
     me = api.me()
-    return me._json['followers_count']
+    return me['followers_count']
 
 
 def build_filter_query():
@@ -98,14 +113,33 @@ def build_filter_query():
     return sql_str, tuple(sql_values)
 
 
+def build_dispatch_query(limit):
+    """ Build SQL query selecting highest scored followers which pass filters and can still receive a DM.
+    :param limit: maximum number of followers
+    :return: SQL query, SQL values
+    """
+    sql_str, sql_values = build_filter_query()
+
+    # filter query always has a WHERE clause
+    sql_str = sql_str + " AND id NOT IN (SELECT id FROM skip_user)" \
+                        " AND id NOT IN (SELECT id FROM dm_status GROUP BY id HAVING count(*) > 1)" \
+                        " ORDER BY score DESC LIMIT ?"
+
+    return sql_str, sql_values + (limit,)
+
+
 def process_user_info(conn, user_info_list):
     """ Process user information retrieved from twitter and store fields into db.
     :param conn: Connection object
     :param user_info_list: User information list retrieved from twitter
     :return: None
     """
+    current_time = str(datetime.now())[:-3]
+    follower_list = []
+    history_list = []
+
     for i in range(len(user_info_list)):
-        user_info = user_info_list[i]._json
+        user_info = user_info_list[i]
 
         user_id = user_info['id']
         name = user_info['name']
@@ -122,19 +156,28 @@ def process_user_info(conn, user_info_list):
         verified = user_info['verified']
 
         user = (user_id, name, created_at, description,
-                followers_count, friends_count, verified)
-        insert_follower(conn, user)
+                followers_count, friends_count, verified, current_time)
+        follower_list.append(user)
+
+        history_list.append((user_id, current_time, followers_count, friends_count))
 
+    upsert_followers(conn, follower_list)
+    insert_follower_history(conn, history_list)
+    score_followers(conn, [follower[0] for follower in follower_list])
 
-def process_test_user_info(user_info_list):
-    """ Process test user information retrieved from twitter.
+
+def process_test_user_info(conn, user_info_list):
+    """ Process test user information retrieved from twitter. Users are refreshed now and
+    scored like followers, so rows have the same dm_template_columns as in live mode.
+    :param conn: Connection object
     :param user_info_list: User information list retrieved from twitter
     :return: Processed user information list
     """
+    current_time = str(datetime.now())[:-3]
     processed_user_info = []
 
     for i in range(len(user_info_list)):
-        user_info = user_info_list[i]._json
+        user_info = user_info_list[i]
 
         user_id = user_info['id']
         name = user_info['name']
@@ -154,84 +197,127 @@ def process_test_user_info(user_info_list):
                 followers_count, friends_count, verified)
         processed_user_info.append(user)
 
-    return processed_user_info
+    if not processed_user_info:
+        return processed_user_info
 
+    scores = score_users(pd.DataFrame(processed_user_info, columns=user_info_columns), query_dm_counts(conn))
 
-def send_dm(api, conn, user_info_list):
-    """ Send DM to followers. Also support sending retry message if retry after limit is reached.
-    :param api: Tweepy api object
+    return [user + (current_time, score) for user, score in zip(processed_user_info, scores.tolist())]
+
+
+def refresh_stale_followers(api, conn):
+    """ Refresh stale follower profiles in full lookup batches, using only the
+    lookup rate limit left over after new follower ingest.
+    :param api: Twitter api client
     :param conn: Connection object
-    :param user_info_list: Processed user information list
     :return: None
     """
+    lookup_users_count = 100
 
-    if test_flag:
-        for i in range(len(user_info_list)):
+    try:
+        rate_limit_status = api.rate_limit_status(resources='users')
+        remaining = rate_limit_status['resources']['users']['/users/lookup']['remaining']
+    except tweepy.TweepError as e:
+        print(f"Error: Tweepy error {str(e)}.")
+        return
 
-            follower_id = user_info_list[i][0]
-            follower_name = user_info_list[i][1]
+    max_batches = min(remaining, profile_refresh_max_batches)
+    if max_batches <= 0:
+        print("No lookup rate limit left for refreshing follower details.")
+        return
 
-            print(f"Sending DM to {follower_name}.")
+    stale_before = str(datetime.now() - timedelta(days=profile_refresh_stale_after_days))[:-3]
+    stale_follower_ids = query_stale_follower_ids(conn, stale_before, build_filter_query(),
+                                                  max_batches * lookup_users_count)
 
-            if not test_retry_message:
-                dm = f"Hi {follower_name},\n" + message
-            else:
-                dm = f"Hi {follower_name},\n" + retry_message
+    if not stale_follower_ids:
+        print("No stale follower details.")
+        return
 
-            try:
-                api.send_direct_message(follower_id, dm)
+    print(f"Refreshing {len(stale_follower_ids)} stale follower details from twitter.")
 
-            except tweepy.RateLimitError as e:
-                print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
-                time.sleep(60 * 15)
-                return
-            except tweepy.TweepError as e:
-                print(f"Error: Tweepy error {str(e)}.")
-                continue
+    for start_index in range(0, len(stale_follower_ids), lookup_users_count):
+        user_id_list = stale_follower_ids[start_index:start_index + lookup_users_count]
 
-    else:
+        try:
+            user_info_list = api.lookup_users(user_id_list)
+            process_user_info(conn, user_info_list)
 
-        for i in range(len(user_info_list)):
+            # followers not returned by twitter are not retried until they are stale again
+            current_time = str(datetime.now())[:-3]
+            mark_followers_refreshed(conn, user_id_list, current_time)
+        except tweepy.RateLimitError as e:
+            print(f"Info: Tweepy rate exceeded {str(e)}. Stopping follower refresh.")
+            return
+        except tweepy.TweepError as e:
+            print(f"Error: Tweepy error {str(e)}.")
+            return
 
-            follower_id = user_info_list[i][0]
-            follower_name = user_info_list[i][1]
 
-            print(f"Sending DM to {follower_name}.")
+def render_dm_outbox(conn, followers, columns):
+    """ Render DMs for shortlisted followers ahead of dispatch and store them in the outbox.
+    Retry message is rendered for followers sent one DM, followers sent two DMs are left out.
+    :param conn: Connection object
+    :param followers: Shortlisted follower rows
+    :param columns: Column names of follower rows
+    :return: True if DMs are rendered else False
+    """
+    dm_counts = query_dm_counts(conn)
+    id_index = columns.index('id')
 
-            follower_dm_status = query_dm_status_by_id(conn, follower_id)
+    eligible_followers = [follower for follower in followers
+                          if dm_counts.get(follower[id_index], 0) < 2]
+    retry_list = [dm_counts.get(follower[id_index], 0) == 1 for follower in eligible_followers]
 
-            if len(follower_dm_status) > 1:
-                print(f"DM sent to {follower_name} twice already.")
-                continue
+    messages = render_messages(eligible_followers, columns, retry_list)
+    if messages is None:
+        return False
 
-            if len(follower_dm_status) == 1:
-                dm = f"Hi {follower_name},\n" + retry_message
-            else:
-                dm = f"Hi {follower_name},\n" + message
+    current_time = str(datetime.now())[:-3]
+    replace_dm_outbox(conn, [dm + (current_time,) for dm in messages])
 
-            try:
-                api.send_direct_message(follower_id, dm)
+    return True
+
+
+def send_dm(api, conn, messages):
+    """ Send rendered DMs to followers.
+    :param api: Twitter api client
+    :param conn: Connection object
+    :param messages: Rendered DM list of (id, retry, variant, body)
+    :return: None
+    """
+    for follower_id, retry, variant, dm in messages:
+
+        print(f"Sending DM to {follower_id}.")
+
+        try:
+            api.send_direct_message(follower_id, dm)
 
+            if not test_flag:
                 current_time = str(datetime.now())[:-3]
-                follower = (follower_id, current_time)
-                insert_dm_status(conn, follower)
+                complete_dm_outbox(conn, follower_id, current_time)
 
-            except tweepy.RateLimitError as e:
-                print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
-                time.sleep(60 * 15)
-                return
-            except tweepy.TweepError as e:
-                print(f"Error: Tweepy error {str(e)}.")
-                error_code = e.args[0][0]['code']
+        except tweepy.RateLimitError as e:
+            print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
+            time.sleep(60 * 15)
+            return
+        except tweepy.TweepError as e:
+            print(f"Error: Tweepy error {str(e)}.")
 
-                # You cannot send messages to this user.
-                if error_code == 349:
-                    current_time = str(datetime.now())[:-3]
-                    skip_user = (follower_id, current_time)
-                    insert_skip_user(conn, skip_user)
-                    continue
+            if test_flag:
+                continue
 
-                return
+            error_code = e.api_code
+
+            # You cannot send messages to this user.
+            if error_code == 349:
+                current_time = str(datetime.now())[:-3]
+                skip_user = (follower_id, current_time)
+                insert_skip_user(conn, skip_user)
+                delete_dm_outbox(conn, follower_id)
+                continue
+
+            return
 
 
 def trigger_follower_processing():
@@ -249,13 +335,18 @@ def trigger_follower_processing():
     # initialize db
     conn = init_db()
 
-    auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-    auth.set_access_token(access_token, access_token_secret)
+    # check DM templates before anything is fetched or sent
+    if (test_flag or enable_dm_flag) and not validate_templates(dm_template_columns, dm_template_sample_row):
+        print("Error: Invalid DM templates. Please fix dm_templates configuration.")
+        return
 
-    api = tweepy.API(auth)
+    api = get_api()
 
     me = api.me()
-    total_followers_count = me._json['followers_count']
+    total_followers_count = me['followers_count']
+
+    current_time = str(datetime.now())[:-3]
+    insert_account_history(conn, (current_time, total_followers_count, me['friends_count']))
 
     # fetching follower ids
     follower_id_list = []
@@ -268,10 +359,10 @@ def trigger_follower_processing():
 
     else:
         print("Fetching follower list from twitter.")
-        follower_id_cursor = tweepy.Cursor(api.followers_ids).items()
+        follower_id_cursor = api.followers_ids()
         while True:
             try:
-                follower_id = follower_id_cursor.next()
+                follower_id = next(follower_id_cursor)
                 follower_info = query_follower_by_id(conn, follower_id)
 
                 if follower_info is None:
@@ -300,10 +391,7 @@ def trigger_follower_processing():
                         if time_difference.days > retry_after_days:
                             follower_id_list.append(follower_id)
 
-            except tweepy.RateLimitError as e:
-                print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
-                time.sleep(60 * 15)
-                continue
+            # rate limits are waited out inside followers_ids
             except tweepy.TweepError as e:
                 print(f"Error: Tweepy error {str(e)}.")
                 return
@@ -351,8 +439,12 @@ def trigger_follower_processing():
             print(test_accounts[:max_test_account])
             user_info_list = api.lookup_users(screen_names=test_accounts[:max_test_account])
 
-            processed_user_info_list = process_test_user_info(user_info_list)
-            send_dm(api, conn, processed_user_info_list)
+            processed_user_info_list = process_test_user_info(conn, user_info_list)
+            retry_list = [test_retry_message] * len(processed_user_info_list)
+            messages = render_messages(processed_user_info_list, dm_template_columns, retry_list)
+
+            if messages is not None:
+                send_dm(api, conn, messages)
 
         except tweepy.RateLimitError as e:
             print(f"Info: Tweepy rate exceeded {str(e)}. Sleeping for 15 minutes.")
@@ -362,18 +454,34 @@ def trigger_follower_processing():
             return
 
     else:
-        # filter users from db based on filters
-        built_query = build_filter_query()
+        # refresh stale followers before filtering
+        refresh_stale_followers(api, conn)
+        ensure_follower_scores(conn)
+
+        # filter users from db based on filters, highest scored first
+        built_query = build_dispatch_query(dm_limit)
 
         cur = conn.cursor()
         cur.execute(built_query[0], built_query[1])
 
         shortlisted_followers = cur.fetchall()
+        columns = [column[0] for column in cur.description]
 
         # sending DM to shortlisted followers
         if enable_dm_flag:
+            print("Rendering DMs for shortlisted followers.")
+            if not render_dm_outbox(conn, shortlisted_followers, columns):
+                return
+
             print("Sending DMs to shortlisted followers.")
-            send_dm(api, conn, shortlisted_followers)
+            messages = query_dm_outbox(conn)
+            send_dm(api, conn, messages)
+
+            # DM count is part of the score
+            score_followers(conn, [dm[0] for dm in messages])
 
         else:
             print("Sending DMs flag is off.")
+
+    request_count, average_latency = summarize_timings('api ')
+    print(f"Twitter api requests: {request_count}, average latency: {average_latency:.1f} ms.")